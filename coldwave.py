@@ -8,6 +8,10 @@ following their definition:
      meet the threshold then the coldwave continues.
 Assumes the following columns in the input daily minimum temperature xlsx file
 table: Aasta, Kuu, Paev, followed by any N of station columns.
+Requires numba (the wave scan is compiled with it), pandas and numpy.
+Input xlsx files are read with python-calamine if it is installed (a lot
+faster), otherwise with openpyxl. Threshold comparison uses numexpr if it is
+installed, otherwise plain NumPy.
 -------------------------------------------------------------------------------
 The script is distributed in the hope that it will be useful, but WITHOUT ANY
 WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
@@ -17,82 +21,136 @@ Author: Sven-Erik Enno, University of Tartu, Department of Geography, 2023.
 -------------------------------------------------------------------------------
 '''
 
+import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import escape
+
 import pandas as pd
 import numpy as np
+from numba import njit
+
+# Optional faster xlsx reader engine.
+try:
+    import python_calamine
+    EXCEL_ENGINE = 'calamine'
+except ImportError:
+    EXCEL_ENGINE = 'openpyxl'
+
+# Optional multi-threaded evaluation of the threshold comparison.
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
+
+# One warm day between two cold days continues the coldwave.
+# Set to False if you dont want to include 1 day between two cold waves.
+BRIDGE_ONE_DAY = True
+
+# Wave kernels made by make_scanner(), by year length, minimum wave duration
+# and the one day bridge setting.
+SCANNERS = {}
+
+# Threshold arrays prepared by prepare_thresholds(), by threshold df id and stations.
+TH_CACHE = {}
+
 
+@njit(cache=True, nogil=True)
+def year_stn_stats(cold_days, n_t, hw_min_days, bridge, n_days, n_hws, max_dur, n_days_hw):
+    '''
+    Given an input boolean array marking the days of N stations during one
+    year that meet the fixed or daily/station specific threshold, find all
+    coldwaves by station during this year and output their statistics. 
+    Args:
+      cold_days = boolean Numpy array days x stations, True if the daily minimum
+        temperature is at or below the coldwave threshold. Compared in float32,
+        so values within about 1e-6 (relative) of the threshold count as equal.
+      n_t = int N of days in the year, same as rows in the array.
+      hw_min_days = minimum duration to be a coldwave, otherwise just cold days.
+      bridge = bool, if one warm day between two cold days continues the wave.
+      n_days = Numpy array to fill, total N of cold days per station (at or below hw_th).
+      n_hws = Numpy array to fill, total N of coldwaves per station.
+      max_dur = Numpy array to fill, max duration of coldwave per station.
+      n_days_hw = Numpy array to fill, total N of days during coldwaves per station.
+    '''
+    
+    n_stns = cold_days.shape[1]
+    for s in range(n_stns):
+        s_days, s_hws, s_max_dur, s_days_hw = 0, 0, 0, 0
+        # Bits of the last three days, lowest bit is today (1 - cold day).
+        last3 = 0
+        cur_run = 0
+        for t in range(n_t + 2):
+            # Pretend the year ends with two warm days to close the last wave.
+            cold = t < n_t and cold_days[t, s]
+            last3 = ((last3 << 1) | cold) & 7
+            s_days += cold
+            # A cold day continues the wave, pattern 101 also adds the warm day between.
+            cur_run += (last3 & 1) * (1 + bridge * (last3 == 5))
+            # The wave ended - pattern 100 (two warm days after a cold day) or
+            # without the bridge already x10 (one warm day after a cold day).
+            ended = last3 == 4 if bridge else (last3 & 3) == 2
+            if ended:
+                # Only coldwaves count for the max duration, shorter runs give 0.
+                if cur_run >= hw_min_days:
+                    s_hws += 1
+                    s_days_hw += cur_run
+                    s_max_dur = max(s_max_dur, cur_run)
+                cur_run = 0
+        n_days[s] = s_days
+        n_hws[s] = s_hws
+        max_dur[s] = s_max_dur
+        n_days_hw[s] = s_days_hw
 
-def year_stn_stats(df_ys, hw_th, hw_min_days):
+
+def make_scanner(n_t, hw_min_days, bridge):
     '''
-    Given an input Pandas df with daily max temperatures of one station during
-    one year, and a fixed or daily/station specific threshold, find all
-    heatwaves for this station during this year and output their statistics. 
+    Get year_stn_stats() specialized for years of exactly n_t days, the
+    given minimum coldwave duration and bridge setting. All are compile time
+    constants in the specialized kernel, so the compiler can unroll and simplify the day loop.
+    Kernels are created once and kept in SCANNERS.
     Args:
-      df_ys = Pandas df, daily maximum temperatures of one station during one year.
-      hw_th = float/int fixed heatwave temperature threshold or Pandas series with 
-        daily thresholds for this station.
-      hw_min_days = minimum duration to be a heatwave, otherwise just heat days.
+      n_t = int N of days in the year.
+      hw_min_days = minimum duration to be a coldwave, otherwise just cold days.
+      bridge = bool, if one warm day between two cold days continues the wave.
     Returns:
-      n_days = int total N of days per year exceeding hw_th.
-      n_hws = int total N of heatwaves.
-      max_dur = int max duration of heatwave.
-      n_days_hw = int total N of days during heatwaves.
+      scanner = compiled function(cold_days, n_days, n_hws, max_dur, n_days_hw),
+        arguments as in year_stn_stats(), cold_days must have exactly n_t rows.
     '''
     
-    # Check if fixed or daily threshold and process accordingly. 
-    if isinstance(hw_th, pd.Series):
-        df_ys = df_ys - hw_th
-        hd_idx = list(df_ys[df_ys <= 0].index)
-    else:
-        hd_idx = list(df_ys[df_ys <= hw_th].index)
-
-    # Now split heat day indices to heatwaves.
-    hws = []
-    hw = []
-    for day in hd_idx:
-        if len(hw) == 0:
-            hw.append(day)
-        else:
-            if (day - hw[-1] == 1):
-                hw.append(day)
-            # Comment out next 3 lines if you dont want to include 1 day between two cold waves.
-            elif (day - hw[-1] == 2):
-                hw.append(day - 1)
-                hw.append(day)
-            else:
-                hws.append(hw)
-                hw = [day]
-    hws.append(hw)
-
-    # Finally get the heatwave stats.
-    durations = [len(hw) for hw in hws]
-    n_days = len(hd_idx)
-    durations_hws = [d for d in durations if d >= hw_min_days]
-    n_hws = len(durations_hws)
-    max_dur = max(durations)
-    n_days_hw = sum(durations_hws)
-    
-    return n_days, n_hws, max_dur, n_days_hw
-
-
-def get_station_th(station, hw_th):
-    '''
-    Find heatwave threshold for this particular station if daily thresholds
-    data frame or just return the fixed threshold value.
+    key = (n_t, hw_min_days, bridge)
+    if key not in SCANNERS:
+        @njit(cache=True, nogil=True)
+        def scanner(cold_days, n_days, n_hws, max_dur, n_days_hw):
+            # Numba does not check bounds, so a wrong year length must not get through.
+            assert cold_days.shape[0] == n_t
+            year_stn_stats(cold_days, n_t, hw_min_days, bridge, n_days, n_hws, max_dur, n_days_hw)
+        SCANNERS[key] = scanner
+    return SCANNERS[key]
+
+
+def prepare_thresholds(hw_th, stations):
+    '''
+    Convert the daily thresholds of the given stations into float32 arrays,
+    with and without the 29th of Feb. The arrays are cached, so repeated
+    process_df() calls with the same threshold df (e.g. parameter sweeps)
+    reuse them - do not modify the threshold df in place between calls.
     Args:
-      station = name of the station as it appears in the input file.
-      hw_th = float/int fixed heatwave temperature threshold or
-        Pandas df stations x days with day/station specific thresholds
-        (note - this must be one number for each day, no need to repeat
-        e.g. 10 times when analyzing 10 years).
+      hw_th = Pandas df stations x days with day/station specific thresholds.
+      stations = tuple of station names.
     Returns:
-      hw_th_stn = int/float or Pandas.Series heatwave threshold for this station.
+      th_arr = float32 Numpy array days x stations, all daily thresholds.
+      th_no_feb29 = float32 Numpy array, the same without the 29th of Feb,
+        None if the thresholds are too short to include it (day 151).
     '''
     
-    try:
-        hw_th_stn = hw_th[station]
-        return hw_th_stn
-    except TypeError as e:
-        return hw_th
+    # The df itself is kept in the cache, so its id can not be reused by another df.
+    key = (id(hw_th), stations)
+    if key not in TH_CACHE:
+        th_arr = hw_th[list(stations)].to_numpy(dtype=np.float32)
+        th_no_feb29 = np.delete(th_arr, 151, axis=0) if len(th_arr) > 151 else None
+        TH_CACHE[key] = (hw_th, th_arr, th_no_feb29)
+    return TH_CACHE[key][1:]
 
 
 def process_df(df, hw_th):
@@ -118,41 +176,152 @@ def process_df(df, hw_th):
     # Defining here as this should always be 3. 
     hw_min_days = 3
     
-    years = df["Aasta"].unique()
-    years = [y for y in years if len(y) > 4]
+    # Keep only rows with a season label (longer than 4 characters) as Aasta.
+    df = df[df['Aasta'].str.len() > 4]
     stations = list(df.columns)[3:]
-    days, hws, max_durs, days_hws = {}, {}, {}, {}
-    for year in years:
-        df_y = df[df['Aasta'] == year]
-        days_y, hws_y, max_durs_y, days_hws_y = {}, {}, {}, {}
-        for stn in stations:
-            if isinstance(hw_th, pd.DataFrame) and stn not in list(hw_th.columns)[3:]:
-                continue
-            df_ys = df_y[stn]
-            df_ys = df_ys.reset_index(drop=True)
-            stn_hw_th = get_station_th(stn, hw_th)
-            # If no 29th of Feb then remove its threshold (only if daily thresholds).
-            if isinstance(stn_hw_th, pd.Series) and len(stn_hw_th) > len(df_ys):
-                stn_hw_th = stn_hw_th.drop(labels=[151], axis=0).reset_index(drop=True)
-            n_days, n_hws, max_dur, n_days_hw = year_stn_stats(df_ys, stn_hw_th, hw_min_days)
-            days_y[stn] = n_days
-            hws_y[stn] = n_hws
-            max_durs_y[stn] = max_dur
-            days_hws_y[stn] = n_days_hw
-        days[year] = days_y
-        hws[year] = hws_y
-        max_durs[year] = max_durs_y
-        days_hws[year] = days_hws_y
-        
-    days = pd.DataFrame(days).transpose()
-    hws = pd.DataFrame(hws).transpose()
-    max_durs = pd.DataFrame(max_durs).transpose()
-    max_durs[max_durs < hw_min_days] = 0
-    days_hws = pd.DataFrame(days_hws).transpose()
+    if isinstance(hw_th, pd.DataFrame):
+        stations = [stn for stn in stations if stn in list(hw_th.columns)[3:]]
+    
+    # Sort by year once, days stay in their original order within the year.
+    years_col = df['Aasta'].to_numpy()
+    order = np.argsort(years_col, kind='stable')
+    years, year_starts = np.unique(years_col[order], return_index=True)
+    if len(years) == 0:
+        # Nothing to process, return empty stats.
+        return pd.DataFrame(), pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
+    # One C-contiguous days x stations matrix, the df is only kept for labels.
+    temps = np.ascontiguousarray(df[stations].to_numpy(dtype=np.float32)[order])
+    
+    # Daily thresholds for every year, matching the temperatures day by day.
+    # Converted to arrays once (cached) and prepared once for every year length.
+    year_lens = np.diff(np.r_[year_starts, len(temps)])
+    if isinstance(hw_th, pd.DataFrame):
+        th_arr, th_no_feb29 = prepare_thresholds(hw_th, tuple(stations))
+        th_years = {}
+        for year_len in np.unique(year_lens):
+            # If no 29th of Feb then use the thresholds without it (if there is one).
+            th_y = th_no_feb29 if th_no_feb29 is not None and len(th_arr) > year_len else th_arr
+            # Days without a threshold can not be cold days.
+            th_y = th_y[:year_len]
+            th_years[year_len] = np.pad(th_y, ((0, year_len - len(th_y)), (0, 0)), constant_values=np.nan)
+        hw_th = np.concatenate([th_years[year_len] for year_len in year_lens])
+    else:
+        # Fixed threshold as a read-only view with the shape of temps, nothing is copied.
+        hw_th = np.broadcast_to(np.float32(hw_th), temps.shape)
+    
+    # Find all cold days at once, multi-threaded with numexpr if available.
+    if ne is not None:
+        cold_days = ne.evaluate('temps <= hw_th')
+    else:
+        cold_days = temps <= hw_th
+    
+    # Compute the stats year by year, every year block is one kernel call.
+    # Years are independent and the kernel releases the GIL, so run them in threads.
+    # The kernels are specialized by year length, usually there are only two.
+    year_ends = year_starts + year_lens
+    scanners = {year_len: make_scanner(int(year_len), hw_min_days, BRIDGE_ONE_DAY) for year_len in np.unique(year_lens)}
+    days, hws, max_durs, days_hws = [np.zeros((len(years), len(stations)), dtype=np.int64) for i in range(4)]
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        futures = [pool.submit(scanners[end - start], cold_days[start:end],
+                               days[i], hws[i], max_durs[i], days_hws[i])
+                   for i, (start, end) in enumerate(zip(year_starts, year_ends))]
+        for future in futures:
+            future.result()
+    
+    # Output dfs straight from the years x stations arrays.
+    days = pd.DataFrame(days, index=years, columns=stations)
+    hws = pd.DataFrame(hws, index=years, columns=stations)
+    max_durs = pd.DataFrame(max_durs, index=years, columns=stations)
+    days_hws = pd.DataFrame(days_hws, index=years, columns=stations)
     
     return days, hws, max_durs, days_hws
 
 
+def xlsx_cell(ref, value):
+    '''
+    Build the XML of one worksheet cell, numbers as values and everything
+    else as an inline string.
+    Args:
+      ref = cell reference, e.g. B2.
+      value = int/float or any value to be written as text.
+    Returns:
+      cell = str XML of the cell.
+    '''
+    
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return f'<c r="{ref}"><v>{value}</v></c>'
+    return f'<c r="{ref}" t="inlineStr"><is><t>{escape(str(value))}</t></is></c>'
+
+
+def xlsx_writer(fname, sheets):
+    '''
+    Write Pandas dfs into an xlsx file by generating the worksheet XML
+    directly, no styles or other workbook features are needed here.
+    Args:
+      fname = full path of the output xlsx file.
+      sheets = list of (worksheet name, Pandas df) pairs, df index is
+        written into the first column and df columns into the first row.
+    '''
+    
+    ns = 'http://schemas.openxmlformats.org/'
+    content_types = ''.join(
+        f'<Override PartName="/xl/worksheets/sheet{k}.xml" '
+        f'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        for k in range(1, len(sheets) + 1))
+    wb_sheets = ''.join(f'<sheet name="{escape(name)}" sheetId="{k}" r:id="rId{k}"/>'
+                        for k, (name, df) in enumerate(sheets, start=1))
+    wb_rels = ''.join(f'<Relationship Id="rId{k}" Type="{ns}officeDocument/2006/relationships/worksheet" '
+                      f'Target="worksheets/sheet{k}.xml"/>' for k in range(1, len(sheets) + 1))
+    parts = {
+        '[Content_Types].xml': (
+            f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            f'<Types xmlns="{ns}package/2006/content-types">'
+            f'<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            f'<Default Extension="xml" ContentType="application/xml"/>'
+            f'<Override PartName="/xl/workbook.xml" '
+            f'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            f'{content_types}</Types>'),
+        '_rels/.rels': (
+            f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            f'<Relationships xmlns="{ns}package/2006/relationships">'
+            f'<Relationship Id="rId1" Type="{ns}officeDocument/2006/relationships/officeDocument" '
+            f'Target="xl/workbook.xml"/></Relationships>'),
+        'xl/workbook.xml': (
+            f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            f'<workbook xmlns="{ns}spreadsheetml/2006/main" '
+            f'xmlns:r="{ns}officeDocument/2006/relationships">'
+            f'<sheets>{wb_sheets}</sheets></workbook>'),
+        'xl/_rels/workbook.xml.rels': (
+            f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            f'<Relationships xmlns="{ns}package/2006/relationships">{wb_rels}</Relationships>'),
+    }
+    
+    for k, (name, df) in enumerate(sheets, start=1):
+        # Column letters A, B, ..., Z, AA, AB, ... for the index and all columns.
+        cols = []
+        for i in range(1, df.shape[1] + 2):
+            col = ''
+            while i:
+                i, r = divmod(i - 1, 26)
+                col = chr(65 + r) + col
+            cols.append(col)
+        # Header row and then the df rows straight as tuples, index first.
+        rows = [(None, *df.columns), *df.itertuples(index=True, name=None)]
+        sheet_data = ''.join(
+            f'<row r="{i}">'
+            + ''.join(xlsx_cell(f'{col}{i}', v) for col, v in zip(cols, row) if v is not None)
+            + '</row>'
+            for i, row in enumerate(rows, start=1))
+        parts[f'xl/worksheets/sheet{k}.xml'] = (
+            f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            f'<worksheet xmlns="{ns}spreadsheetml/2006/main">'
+            f'<sheetData>{sheet_data}</sheetData></worksheet>')
+
+    with zipfile.ZipFile(fname, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for part, xml in parts.items():
+            zf.writestr(part, xml)
+
+
 def output_writer(fname, days, hws, max_durs, days_hws):
     '''
     Write the results into an xlsx file, on four separate worksheets.
@@ -162,21 +331,30 @@ def output_writer(fname, days, hws, max_durs, days_hws):
         described in process_df() output.
     '''
     
-    # Create a Pandas Excel writer using XlsxWriter as the engine.
-    writer = pd.ExcelWriter(fname, engine='xlsxwriter')
-    
-    # Write each dataframe to a different worksheet.
-    days.to_excel(writer, sheet_name='N_days')
-    hws.to_excel(writer, sheet_name='N_waves')
-    max_durs.to_excel(writer, sheet_name='Max_duration')
-    days_hws.to_excel(writer, sheet_name='N_days_hwaves')
-
-    # Close the Pandas Excel writer and output the Excel file.
-    writer.close()
+    # Write each dataframe to a different worksheet, years as the first column.
+    sheets = [('N_days', days), ('N_waves', hws), ('Max_duration', max_durs), ('N_days_hwaves', days_hws)]
+    xlsx_writer(fname, sheets)
     
     print(f'FINISHED! Output data written to {fname}.')
     
 
+def sheet_reader(xl, ws_name, dtype=np.float32):
+    '''
+    Read one worksheet of the input xlsx file with the station columns
+    (everything after Aasta, Kuu, Paev) declared as dtype up front.
+    Args:
+      xl = Pandas ExcelFile, the opened input xlsx file.
+      ws_name = name or index of the worksheet.
+      dtype = Numpy dtype of the station columns, float32 for temperatures.
+    Returns:
+      df = Pandas dataframe containing all data in the worksheet.
+    '''
+    
+    # Read only the header first to find the station columns.
+    stations = list(xl.parse(ws_name, nrows=0).columns)[3:]
+    return xl.parse(ws_name, dtype={stn: dtype for stn in stations})
+
+
 def input_reader(fname, ws_data_name=None, ws_th_name=None):
     '''
     Read the daily maximum temperatures and, if required, also the daily
@@ -191,12 +369,15 @@ def input_reader(fname, ws_data_name=None, ws_th_name=None):
         file, None if no data/fixed threshold.
     '''
     
-    if ws_data_name is None:
-        return pd.read_excel(fname), None
-    elif ws_th_name is None:
-        return pd.read_excel(fname, sheet_name=ws_data_name), None
-    else:
-        return pd.read_excel(fname, sheet_name=ws_data_name), pd.read_excel(fname, sheet_name=ws_th_name)
+    # Open the file once and parse all the required worksheets from it.
+    with pd.ExcelFile(fname, engine=EXCEL_ENGINE) as xl:
+        if ws_data_name is None:
+            return sheet_reader(xl, 0), None
+        elif ws_th_name is None:
+            return sheet_reader(xl, ws_data_name), None
+        else:
+            # Thresholds stay float64 as read, they are only cast for the comparison.
+            return sheet_reader(xl, ws_data_name), sheet_reader(xl, ws_th_name, dtype=np.float64)
     
 
 